@@ -1,20 +1,114 @@
 import flet as ft
 import asyncio
+import time
+from bisect import bisect_left
+from types import SimpleNamespace
 
 # from bosesoundtouchapi.models import Navigate
 from bosesoundtouchapi.models.navigate import Navigate
+from playqueue import ENUM_CONCURRENCY, enumerate_tracks
+from scheduler import INTERACTIVE, PREFETCH, VISIBLE
+from snapshot import is_standin
 
 
 # Configuration
 SOURCE = "STORED_MUSIC"
 
-
-def create_filebrowser(client, accountid, saved_path, on_close, page):
+# Icon and color per item type
+ITEM_ICONS = {
+    "dir": (ft.Icons.FOLDER, ft.Colors.YELLOW_700),
+    "track": (ft.Icons.MUSIC_NOTE, ft.Colors.BLUE_400),
+}
+DEFAULT_ICON = (ft.Icons.AUDIO_FILE_OUTLINED, ft.Colors.BLUE_300)
+
+# Folders first when sorting by type
+TYPE_ORDER = {"dir": 0, "track": 1}
+
+# Seconds between keys before the type-ahead buffer starts over
+TYPEAHEAD_TIMEOUT = 1.0
+
+
+def create_filebrowser(
+    client,
+    accountid,
+    saved_path,
+    on_close,
+    page,
+    scheduler=None,
+    play_queue=None,
+    folder_cache=None,
+    known_folders=None,
+):
     current_items = []
     path_stack = saved_path
+    scroll_offset = 0
+
+    # Reusable row controls, rebound on every navigation
+    row_pool = []
+
+    # Case-folded keys and sort orders for the current listing
+    name_keys = []
+    orders = {"device": []}
+    sorted_names = []
+
+    # Item indices currently shown and their row positions
+    shown = []
+    shown_filter = ""
+    shown_sort = "device"
+    row_position = {}
+
+    typeahead = ""
+    typeahead_time = 0.0
+    filter_focused = False
+
+    # Device calls go through the speaker's scheduler when there is one
+    def request(fn, priority, key=None):
+        if scheduler is None:
+            return fn()
+        return scheduler.run(fn, priority, key)
+
+    async def request_async(fn, priority, key=None):
+        if scheduler is None:
+            return await asyncio.get_event_loop().run_in_executor(None, fn)
+        return await asyncio.wrap_future(scheduler.submit(fn, priority, key))
+
+    def browse_key(container_item):
+        if container_item is None:
+            return ("browse", None)
+        return ("browse", container_item.ContentItem.Location)
+
+    async def list_folder(container_item, priority=VISIBLE):
+        nav = Navigate(
+            source=SOURCE, sourceAccount=accountid, containerItem=container_item
+        )
+        result = await request_async(
+            lambda: client.GetMusicLibraryItems(nav),
+            priority,
+            browse_key(container_item),
+        )
+        if known_folders is not None:
+            # lets the controller list the folder of whatever is playing
+            for item in result.Items:
+                if item.TypeValue == "dir":
+                    known_folders[item.ContentItem.Location] = item
+        return result.Items
+
+    def remember_scroll(e):
+        nonlocal scroll_offset
+        scroll_offset = e.pixels
 
     # UI Components
-    file_list = ft.Column([], spacing=5, scroll="auto")
+    empty_label = ft.Text(
+        "(Empty folder)", color=ft.Colors.GREY_400, italic=True, visible=False
+    )
+
+    file_list = ft.Column(
+        [empty_label],
+        spacing=5,
+        scroll="auto",
+        on_scroll=remember_scroll,
+        scroll_interval=200,
+    )
 
     path_display = ft.Text(
         "",
@@ -32,6 +126,35 @@ def create_filebrowser(client, accountid, saved_path, on_close, page):
 
     progress_ring = ft.ProgressRing(width=20, height=20, visible=False)
 
+    offline_label = ft.Text(
+        "Offline (cached)", size=12, color=ft.Colors.ORANGE_300, visible=False
+    )
+
+    def set_filter_focus(focused):
+        nonlocal filter_focused
+        filter_focused = focused
+
+    filter_field = ft.TextField(
+        hint_text="Filter",
+        dense=True,
+        expand=True,
+        on_change=lambda e: apply_view(),
+        on_focus=lambda e: set_filter_focus(True),
+        on_blur=lambda e: set_filter_focus(False),
+    )
+
+    sort_dropdown = ft.Dropdown(
+        value="device",
+        width=110,
+        dense=True,
+        options=[
+            ft.dropdown.Option("device", "Device"),
+            ft.dropdown.Option("name", "Name"),
+            ft.dropdown.Option("type", "Type"),
+        ],
+        on_change=lambda e: apply_view(),
+    )
+
     def update_path_display():
         if not path_stack:
             path_display.value = "Root"
@@ -43,6 +166,121 @@ def create_filebrowser(client, accountid, saved_path, on_close, page):
         if path_display.page:
             path_display.update()
 
+    def create_row(pos):
+        row_content = ft.Row(
+            [
+                ft.Icon(size=20),
+                ft.Text("", size=13, color=ft.Colors.WHITE, expand=True),
+                ft.IconButton(
+                    icon=ft.Icons.PLAY_ARROW,
+                    icon_size=20,
+                    icon_color=ft.Colors.GREEN_400,
+                    on_click=lambda e: handle_row_event(e.control.data, "button"),
+                    padding=ft.padding.symmetric(horizontal=15),
+                ),
+            ],
+            alignment=ft.MainAxisAlignment.SPACE_BETWEEN,
+        )
+
+        return ft.GestureDetector(
+            content=ft.Container(
+                content=row_content,
+                bgcolor=ft.Colors.GREY_800,
+                border_radius=5,
+                padding=ft.padding.symmetric(horizontal=10, vertical=0),
+            ),
+            on_tap=lambda e: handle_row_event(e.control.data, "row"),
+            on_long_press=lambda e: handle_row_event(e.control.data, "long_press"),
+            mouse_cursor=ft.MouseCursor.CLICK,
+            key=f"row-{pos}",
+        )
+
+    def bind_row(row, idx, item):
+        icon, name, play_button = row.content.content.controls
+        icon.name, icon.color = ITEM_ICONS.get(item.TypeValue, DEFAULT_ICON)
+        name.value = item.Name
+        row.data = idx
+        play_button.data = idx
+        row.visible = True
+
+    def bind_rows(indices):
+        # grow the pool only when a folder is larger than any seen before
+        while len(row_pool) < len(indices):
+            row = create_row(len(row_pool))
+            row_pool.append(row)
+            file_list.controls.append(row)
+
+        for pos, row in enumerate(row_pool):
+            if pos < len(indices):
+                idx = indices[pos]
+                bind_row(row, idx, current_items[idx])
+            else:
+                row.visible = False
+
+        empty_label.visible = not indices
+
+    def index_listing():
+        nonlocal name_keys, orders, sorted_names, shown_filter
+        name_keys = [item.Name.casefold() for item in current_items]
+        by_name = sorted(range(len(current_items)), key=name_keys.__getitem__)
+        orders = {
+            "device": list(range(len(current_items))),
+            "name": by_name,
+            # stable sort keeps name order within each type
+            "type": sorted(
+                by_name,
+                key=lambda i: TYPE_ORDER.get(current_items[i].TypeValue, 2),
+            ),
+        }
+        sorted_names = [name_keys[i] for i in by_name]
+        shown_filter = ""
+        filter_field.value = ""
+
+    def apply_view():
+        nonlocal shown, shown_filter, shown_sort, row_position
+        text = (filter_field.value or "").casefold()
+        sort = sort_dropdown.value or "device"
+
+        # a longer filter only narrows the rows already shown
+        if sort == shown_sort and shown_filter and text.startswith(shown_filter):
+            candidates = shown
+        else:
+            candidates = orders[sort]
+        shown = [i for i in candidates if text in name_keys[i]] if text else candidates
+        shown_filter = text
+        shown_sort = sort
+        row_position = {idx: pos for pos, idx in enumerate(shown)}
+
+        bind_rows(shown)
+        if file_list.page:
+            file_list.update()
+
+    def jump_to_prefix(prefix):
+        lo = bisect_left(sorted_names, prefix)
+        hi = bisect_left(sorted_names, prefix + chr(0x10FFFF), lo)
+        positions = [
+            row_position[idx] for idx in orders["name"][lo:hi] if idx in row_position
+        ]
+        if positions and file_list.page:
+            file_list.scroll_to(key=f"row-{min(positions)}", duration=100)
+
+    def handle_key(e):
+        nonlocal typeahead, typeahead_time
+        if e.key == "Escape":
+            return False
+        if filter_focused:
+            return True  # typing in the filter box
+        if len(e.key) != 1 or not e.key.isalnum() or e.ctrl or e.alt or e.meta:
+            return False
+
+        now = time.monotonic()
+        if now - typeahead_time > TYPEAHEAD_TIMEOUT:
+            typeahead = ""
+        typeahead += e.key.casefold()
+        typeahead_time = now
+        jump_to_prefix(typeahead)
+        return True
+
     async def browse_folder_async(container_item=None, add_to_stack=True):
         nonlocal current_items
 
@@ -50,79 +288,31 @@ def create_filebrowser(client, accountid, saved_path, on_close, page):
             if add_to_stack and container_item is not None:
                 path_stack.append(container_item)
 
-            nav = Navigate(
-                source=SOURCE, sourceAccount=accountid, containerItem=container_item
-            )
-
             progress_ring.visible = True
             progress_ring.update()
 
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                None, lambda: client.GetMusicLibraryItems(nav)
-            )
-            current_items = result.Items
+            # fall back to the last listing seen while the device is unreachable
+            try:
+                current_items = await list_folder(container_item)
+                offline_label.visible = False
+                if folder_cache is not None:
+                    folder_cache.store(container_item, current_items, path_stack)
+            except Exception:
+                cached = folder_cache.load(container_item) if folder_cache else None
+                if cached is None:
+                    raise
+                current_items = cached
+                offline_label.visible = True
+            offline_label.update()
             # print("length:", len(current_items))
             # this somehow only loads 1000 items max (?)
 
-            file_list.controls.clear()
-
-            if not current_items:
-                file_list.controls.append(
-                    ft.Text("(Empty folder)", color=ft.Colors.GREY_400, italic=True)
-                )
-            else:
-                for idx, item in enumerate(current_items):
-                    if item.TypeValue == "dir":
-                        icon = ft.Icons.FOLDER
-                        icon_color = ft.Colors.YELLOW_700
-                    elif item.TypeValue == "track":
-                        icon = ft.Icons.MUSIC_NOTE
-                        icon_color = ft.Colors.BLUE_400
-                    else:
-                        icon = ft.Icons.AUDIO_FILE_OUTLINED
-                        icon_color = ft.Colors.BLUE_300
-
-                    row_content = ft.Row(
-                        [
-                            # ft.Text(str(idx + 1), color=ft.Colors.WHITE24),
-                            ft.Icon(icon, color=icon_color, size=20),
-                            ft.Text(
-                                item.Name,
-                                size=13,
-                                color=ft.Colors.WHITE,
-                                expand=True,
-                            ),
-                            ft.IconButton(
-                                icon=ft.Icons.PLAY_ARROW,
-                                icon_size=20,
-                                icon_color=ft.Colors.GREEN_400,
-                                data=idx,
-                                on_click=lambda e, item=item: handle_item_click(
-                                    item, "button"
-                                ),
-                                padding=ft.padding.symmetric(horizontal=15),
-                            ),
-                        ],
-                        alignment=ft.MainAxisAlignment.SPACE_BETWEEN,
-                    )
-
-                    item_row = ft.GestureDetector(
-                        content=ft.Container(
-                            content=row_content,
-                            bgcolor=ft.Colors.GREY_800,
-                            border_radius=5,
-                            padding=ft.padding.symmetric(horizontal=10, vertical=0),
-                        ),
-                        on_tap=lambda e, item=item: handle_item_click(item, "row"),
-                        mouse_cursor=ft.MouseCursor.CLICK,
-                    )
-
-                    file_list.controls.append(item_row)
+            index_listing()
+            apply_view()
 
             update_path_display()
             if file_list.page:
-                file_list.update()
+                filter_field.update()
                 file_list.scroll_to(offset=0)
 
             progress_ring.visible = False
@@ -134,16 +324,63 @@ def create_filebrowser(client, accountid, saved_path, on_close, page):
     def browse_folder(container_item=None, add_to_stack=True):
         page.run_task(browse_folder_async, container_item, add_to_stack)
 
+    def handle_row_event(idx, source):
+        if idx is not None and idx < len(current_items):
+            handle_item_click(current_items[idx], source)
+
     def handle_item_click(item, source=None):
         if source == "row" and item.TypeValue == "dir":
             browse_folder(item, add_to_stack=True)
+        elif item.TypeValue == "dir" and play_queue is not None:
+            # long press shuffles the folder and everything below it
+            page.run_task(play_subtree_async, item, source == "long_press")
         else:
             play_item(item)  # play folder or track
 
+    # Play all tracks below a folder, starting as soon as the first is found
+    async def play_subtree_async(folder_item, shuffle=False):
+        try:
+            progress_ring.visible = True
+            progress_ring.update()
+
+            root_items = await list_folder(folder_item)
+            if not shuffle and all(i.TypeValue != "dir" for i in root_items):
+                # no subfolders: let the speaker play the folder itself
+                await asyncio.get_event_loop().run_in_executor(
+                    None, play_item, folder_item
+                )
+                return
+
+            print("Playing subtree:", folder_item.Name)
+            generation = play_queue.start(shuffle)
+
+            async def list_items(container_item):
+                if container_item is folder_item:
+                    return root_items
+                if play_queue.generation != generation:
+                    return []  # another play replaced this one
+                return await list_folder(container_item, PREFETCH)
+
+            def add_tracks(tracks):
+                play_queue.add(generation, tracks)
+
+            concurrency = scheduler.max_prefetch if scheduler else ENUM_CONCURRENCY
+            found = await enumerate_tracks(
+                list_items, folder_item, add_tracks, concurrency
+            )
+            print(f"Queued {found} tracks from {folder_item.Name}")
+        except Exception as e:
+            print(f"Subtree play error: {str(e)}")
+        finally:
+            progress_ring.visible = False
+            progress_ring.update()
+
     def play_item(item):
         print("Playing:", item.ContentItem.Name)
+        if play_queue is not None:
+            play_queue.stop()
         try:
-            msg = client.PlayContentItem(item.ContentItem)
+            msg = request(lambda: client.PlayContentItem(item.ContentItem), INTERACTIVE)
             print("msg:", msg)
         except Exception as e:
             print(f"Play error: {str(e)}")
@@ -158,7 +395,7 @@ def create_filebrowser(client, accountid, saved_path, on_close, page):
     try:
         if not path_stack:
             nav = Navigate(source=SOURCE, sourceAccount=accountid, containerItem=None)
-            result = client.GetMusicLibraryItems(nav)
+            result = request(lambda: client.GetMusicLibraryItems(nav), VISIBLE)
             folder_item = next(
                 (item for item in result.Items if item.Name == "Folder"), None
             )
@@ -167,7 +404,9 @@ def create_filebrowser(client, accountid, saved_path, on_close, page):
                 nav_folder = Navigate(
                     source=SOURCE, sourceAccount=accountid, containerItem=folder_item
                 )
-                folder_result = client.GetMusicLibraryItems(nav_folder)
+                folder_result = request(
+                    lambda: client.GetMusicLibraryItems(nav_folder), VISIBLE
+                )
                 target_item = next(
                     (
                         item
@@ -194,6 +433,15 @@ def create_filebrowser(client, accountid, saved_path, on_close, page):
 
     update_path_display()
 
+    # Called when the browser is shown again after being hidden
+    def on_show():
+        if file_list.page and scroll_offset:
+            file_list.scroll_to(offset=scroll_offset)
+
+    # True while the listing or path came from the snapshot, not the device
+    def showing_cached():
+        return any(is_standin(item) for item in current_items + path_stack)
+
     # Build the UI
     ui = ft.Container(
         content=ft.Column(
@@ -201,6 +449,7 @@ def create_filebrowser(client, accountid, saved_path, on_close, page):
                 ft.Row(
                     [
                         back_button,
+                        offline_label,
                         progress_ring,
                         ft.IconButton(
                             icon=ft.Icons.CLOSE,
@@ -210,6 +459,7 @@ def create_filebrowser(client, accountid, saved_path, on_close, page):
                     ],
                     alignment=ft.MainAxisAlignment.SPACE_BETWEEN,
                 ),
+                ft.Row([filter_field, sort_dropdown], spacing=10),
                 # path_display,
                 ft.Container(
                     content=file_list,
@@ -226,6 +476,9 @@ def create_filebrowser(client, accountid, saved_path, on_close, page):
         ),
         padding=20,
         expand=True,
+        data=SimpleNamespace(
+            on_show=on_show, handle_key=handle_key, showing_cached=showing_cached
+        ),
     )
     return ui
 
@@ -0,0 +1,111 @@
+import random
+import threading
+import time
+
+import requests
+
+from traffic import probe_connection
+
+# Circuit states
+CLOSED = "closed"  # device answers, requests go through
+OPEN = "open"  # device unreachable, requests fail fast
+HALF_OPEN = "half_open"  # liveness probe in progress
+
+
+class DeviceUnavailable(Exception):
+    pass
+
+
+# True if the exception (or one it was raised from) means the device did not answer
+def is_connection_error(ex):
+    while ex is not None:
+        if isinstance(ex, (requests.RequestException, OSError)):
+            return True
+        ex = ex.__cause__ or ex.__context__
+    return False
+
+
+# Per-device health tracking
+#
+# After `failure_threshold` connection errors in a row the circuit opens and
+# every request fails fast with DeviceUnavailable. Once the backoff delay has
+# passed, a cheap TCP probe of the device port decides whether to close the
+# circuit again or to double the delay (up to `max_delay`). Delays are
+# jittered so several panels do not all probe the speaker at the same moment.
+class DeviceHealth:
+    def __init__(
+        self,
+        host,
+        port=8090,
+        failure_threshold=3,
+        base_delay=1.0,
+        max_delay=60.0,
+        probe_timeout=1.0,
+    ):
+        self.host = host
+        self.port = port
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.probe_timeout = probe_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.delay = base_delay
+        self.retry_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return self.state == CLOSED
+
+    def allow_request(self):
+        return self.state == CLOSED
+
+    # Seconds until the next probe is due
+    def retry_in(self):
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def probe_due(self):
+        return self.state == OPEN and time.monotonic() >= self.retry_at
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.delay = self.base_delay
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self._open()
+
+    # Open the circuit right away, e.g. when starting without the device
+    def mark_unreachable(self):
+        with self._lock:
+            self.failures = max(self.failures, self.failure_threshold)
+            self._open()
+
+    def _open(self):
+        # called with the lock held
+        self.state = OPEN
+        self.retry_at = time.monotonic() + self.delay * random.uniform(0.5, 1.0)
+        self.delay = min(self.delay * 2, self.max_delay)
+
+    # Record the outcome of a request (ex is None on success)
+    def record(self, ex=None):
+        if ex is not None and is_connection_error(ex):
+            self.record_failure()
+        else:
+            self.record_success()  # any answer means the device is up
+
+    # Cheap liveness check: can we open a TCP connection to the device port?
+    def probe(self):
+        with self._lock:
+            if self.state == OPEN:
+                self.state = HALF_OPEN
+        if not probe_connection(self.host, self.port, self.probe_timeout):
+            self.record_failure()
+            return False
+        self.record_success()
+        return True
@@ -0,0 +1,173 @@
+import argparse
+import json
+import threading
+import time
+from collections import Counter, deque
+from pathlib import Path
+
+# Buffered records are written once this many are waiting ...
+FLUSH_BATCH = 20
+# ... or once the oldest has waited this many seconds
+FLUSH_INTERVAL = 60
+# Tracks kept in memory for recent-history queries
+RECENT_SIZE = 200
+
+
+# Play history recorder
+#
+# observe() is called with every status snapshot and only compares it with
+# the last one in memory, so the status loop does no disk I/O. Track changes
+# are buffered and appended in batches by flush(), which runs off the status
+# loop. Next to the append-only log, an index file keeps the play counts and
+# recent tracks together with the log size they cover, so loading only has to
+# read log records written after the last index save.
+class PlayHistory:
+    def __init__(self, path=None):
+        self.path = Path(path or Path.home() / ".bose_soundtouch_history.jsonl")
+        self.index_path = self.path.with_suffix(".index.json")
+        self.counts = Counter()
+        self.recent_tracks = deque(maxlen=RECENT_SIZE)
+        self.last_seen = {}  # ipaddr -> key of the track playing there
+        self.buffer = []
+        self.flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._indexed_size = 0
+        self.load()
+
+    @staticmethod
+    def track_key(record):
+        return f"{record['tr']}\x1f{record['ar']}\x1f{record['al']}"
+
+    def load(self):
+        try:
+            if self.index_path.exists():
+                with open(self.index_path, "r") as f:
+                    index = json.load(f)
+                self.counts.update(index["counts"])
+                self.recent_tracks.extend(index["recent"])
+                self._indexed_size = index["size"]
+            if self.path.exists():
+                with open(self.path, "rb") as f:
+                    f.seek(self._indexed_size)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break  # partial last line from an interrupted write
+                        self._index(json.loads(line))
+                    self._indexed_size = f.tell()
+        except Exception as e:
+            print(f"Error loading play history: {e}")
+
+    def _index(self, record):
+        self.counts[self.track_key(record)] += 1
+        self.recent_tracks.append(record)
+
+    # Record a track change seen in a now playing status
+    def observe(self, ipaddr, device_name, np):
+        track = getattr(np, "Track", "") or ""
+        if np.PlayStatus == "STOP_STATE":
+            # playing the same track again afterwards is a new play, while
+            # resuming after a pause is not
+            self.last_seen.pop(ipaddr, None)
+            return
+        if not track or np.PlayStatus != "PLAY_STATE":
+            return
+        artist = getattr(np, "Artist", "") or ""
+        album = getattr(np, "Album", "") or ""
+        key = (track, artist, album)
+        if self.last_seen.get(ipaddr) == key:
+            return
+        self.last_seen[ipaddr] = key
+
+        record = {
+            "t": int(time.time()),
+            "d": ipaddr,
+            "n": device_name,
+            "tr": track,
+            "ar": artist,
+            "al": album,
+            "s": getattr(np.ContentItem, "Source", None),
+        }
+        with self._lock:
+            self._index(record)
+            self.buffer.append(record)
+
+    def flush_due(self):
+        if not self.buffer:
+            return False
+        waited = time.monotonic() - self.flushed_at
+        return len(self.buffer) >= FLUSH_BATCH or waited > FLUSH_INTERVAL
+
+    # Append buffered records to the log and save the index
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                records, self.buffer = self.buffer, []
+                self.flushed_at = time.monotonic()
+                counts = dict(self.counts)
+                recent = list(self.recent_tracks)
+            if not records:
+                return
+            try:
+                lines = "".join(
+                    json.dumps(r, separators=(",", ":")) + "\n" for r in records
+                )
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+                    size = f.tell()
+            except Exception as e:
+                print(f"Error saving play history: {e}")
+                with self._lock:
+                    self.buffer[:0] = records
+                return
+            # the records are in the log now; a stale index is caught up
+            # from the log on the next load
+            try:
+                index = {"size": size, "counts": counts, "recent": recent}
+                tmp = self.index_path.with_suffix(".tmp")
+                with open(tmp, "w") as f:
+                    json.dump(index, f, separators=(",", ":"))
+                tmp.replace(self.index_path)
+                self._indexed_size = size
+            except Exception as e:
+                print(f"Error saving play history index: {e}")
+
+    # Most recent plays, newest first
+    def recent(self, n=20, ipaddr=None):
+        with self._lock:
+            records = reversed(self.recent_tracks)
+            if ipaddr:
+                records = (r for r in records if r["d"] == ipaddr)
+            return [r for _, r in zip(range(n), records)]
+
+    # Most played tracks as ((track, artist, album), count)
+    def most_played(self, n=20):
+        with self._lock:
+            top = self.counts.most_common(n)
+        return [(tuple(key.split("\x1f")), count) for key, count in top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SoundTouch play history")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    recent = sub.add_parser("recent", help="show the latest plays")
+    recent.add_argument("-n", type=int, default=20)
+    recent.add_argument("--device", help="only plays on this speaker")
+
+    top = sub.add_parser("top", help="show the most played tracks")
+    top.add_argument("-n", type=int, default=20)
+
+    args = parser.parse_args()
+    history = PlayHistory()
+    if args.command == "recent":
+        for r in history.recent(args.n, args.device):
+            played = time.strftime("%Y-%m-%d %H:%M", time.localtime(r["t"]))
+            print(f"{played}  {r['n'] or r['d']}: {r['tr']} - {r['ar']}")
+    else:
+        for (track, artist, album), count in history.most_played(args.n):
+            print(f"{count:5}  {track} - {artist} ({album})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+
+# State kept in memory and written back to a JSON file now and then
+#
+# Changes only set `dirty` (under `_lock`); save() writes the file through a
+# temporary file and is called from the background loop once save_due()
+# says at least `save_interval` seconds have passed since the last write.
+# Subclasses provide dump(), the file contents, called with the lock held.
+# Writes are serialized, so the atexit save cannot race one from the loop.
+class ThrottledJsonFile(ABC):
+    def __init__(self, path, save_interval, description):
+        self.path = Path(path)
+        self.save_interval = save_interval
+        self.description = description  # for error messages
+        self.dirty = False
+        self.saved_at = 0.0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    # Parsed file contents, or `default` if there is no readable file
+    def read(self, default):
+        try:
+            if self.path.exists():
+                with open(self.path, "r") as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"Error loading {self.description}: {e}")
+        return default
+
+    @abstractmethod
+    def dump(self):
+        pass
+
+    def save_due(self):
+        return self.dirty and time.monotonic() - self.saved_at > self.save_interval
+
+    def save(self):
+        with self._write_lock:
+            with self._lock:
+                if not self.dirty:
+                    return
+                data = self.dump()
+                self.dirty = False
+                self.saved_at = time.monotonic()
+            try:
+                tmp = self.path.with_suffix(".tmp")
+                with open(tmp, "w") as f:
+                    f.write(data)
+                tmp.replace(self.path)
+            except Exception as e:
+                print(f"Error saving {self.description}: {e}")
+                with self._lock:
+                    self.dirty = True
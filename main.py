@@ -1,16 +1,49 @@
 from bosesoundtouchapi.models.contentitem import ContentItem
+from bosesoundtouchapi.models.navigate import Navigate
 import flet as ft
 import json
 import requests
 import asyncio
+import atexit
+from collections import OrderedDict
+import threading
+import time
 import xml.etree.ElementTree as ET
 import pprint
-from bosesoundtouchapi import SoundTouchClient, SoundTouchDevice, SoundTouchDiscovery
+from bosesoundtouchapi import SoundTouchClient, SoundTouchDevice
 from pathlib import Path
 from filebrowser import create_filebrowser
+from health import DeviceHealth, DeviceUnavailable
+from history import PlayHistory
+from playqueue import PlayQueue
+from presets import fetch_presets, preset_label, preset_snapshot
+from registry import DeviceRegistry
+import traffic
+from snapshot import FolderCache, StateSnapshot, is_standin
+from scheduler import (
+    BACKGROUND,
+    INTERACTIVE,
+    VISIBLE,
+    RequestExpired,
+    RequestScheduler,
+)
 
 # Configuration
 SOURCE = "STORED_MUSIC"
+STATUS_INTERVAL = 1  # seconds between background status polls
+PRESET_REFRESH_INTERVAL = 60  # seconds between background preset refreshes
+REQUEST_TIMEOUT = 3  # seconds for raw HTTP requests to the device
+SKIP_WINDOW = 0.4  # seconds to collect skip presses into one command batch
+COMMAND_EXPIRY = 30  # seconds a command issued while offline waits for the device
+REPEAT_CYCLE = ["REPEAT_OFF", "REPEAT_ALL", "REPEAT_ONE"]  # order of repeat presses
+
+
+# Device id (the MAC address) from the answer to /info, if it has one
+def info_device_id(content):
+    try:
+        return ET.fromstring(content).get("deviceID")
+    except ET.ParseError:
+        return None
 
 
 class BoseSoundTouchController:
@@ -25,10 +58,38 @@ class BoseSoundTouchController:
 
         self.device = None
         self.client = None
+        self.scheduler = None
+        self.health = None
+        self.device_unreachable = False
+        self.device_name = ""
+        self.track_number = None
+        self.device_id = None  # from /info or the saved config
+        self.presets = {}  # device key -> preset per slot (None if empty)
+        self.presets_loaded_at = 0.0
+        self.history = PlayHistory()
+        self.play_queue = PlayQueue(self.play_queued)
+        self.known_folders = {}  # location -> folder item listed by the browser
+        self.snapshot = StateSnapshot()
+        atexit.register(self.snapshot.save)
+        self.pending_commands = OrderedDict()  # kind -> (command, expires at)
+        self.offline_skip = 0
+        self.offline_repeat = 0
+        self.command_lock = threading.Lock()
+        self.waiting_for_device = False
+        self.connect_lock = threading.Lock()  # one connect from startup or discovery
+        self.registry = DeviceRegistry(on_change=self.device_changed)
+        self.registry.start()
+        atexit.register(self.registry.save)
+        atexit.register(self.history.flush)
+        self.pending_skip = 0
+        self.skip_timer = None
+        self.skip_lock = threading.Lock()
         self.ipaddr = ""
         self.config_file = Path.home() / ".bose_soundtouch_config.json"
         self.accountid = ""
         self.last_path = []
+        self.filebrowser = None
+        self.filebrowser_key = None
 
         # --------------------------------------------------------------------------------
         # Flet UI components
@@ -185,7 +246,15 @@ class BoseSoundTouchController:
                     shape=ft.RoundedRectangleBorder(radius=12),
                 ),
             )
-            btn.content = ft.Text(f"{i}", size=16)
+            btn.content = ft.Column(
+                [
+                    ft.Text(f"{i}", size=16),
+                    ft.Text("", size=9, max_lines=1, width=60, visible=False),
+                ],
+                spacing=0,
+                tight=True,
+                horizontal_alignment=ft.CrossAxisAlignment.CENTER,
+            )
             self.preset_buttons.append(btn)
 
         presets_row1 = ft.Row(
@@ -272,11 +341,12 @@ class BoseSoundTouchController:
 
         # Load saved config and try to auto-connect
         saved = self.load_config()
-        if saved and saved.get("last_ip"):
-            print("Found last saved IP address")
-            self.auto_connect_saved(saved)
-        else:
-            self.discover_devices()
+        with self.connect_lock:
+            if saved and saved.get("last_ip"):
+                print("Found last saved IP address")
+                self.auto_connect_saved(saved)
+            else:
+                self.discover_devices()
         self.page.update()
         self.page.on_keyboard_event = self.handle_key_event
 
@@ -295,56 +365,128 @@ class BoseSoundTouchController:
         return {}
 
     # Save config to file
-    def save_config(self, ipaddr, name):
+    def save_config(self, ipaddr, name, device_id=None):
         try:
-            config = {"last_ip": ipaddr, "last_name": name}
+            config = {"last_ip": ipaddr, "last_name": name, "last_id": device_id}
             with open(self.config_file, "w") as f:
                 json.dump(config, f, indent=2)
         except Exception as e:
             print(f"Error saving config: {e}")
 
+    # Key for the snapshot and preset cache: the device id survives a new
+    # DHCP address, the address is only used while the id is unknown
+    def device_key(self):
+        return self.device_id or self.ipaddr
+
     # Connect to last known device
     def auto_connect_saved(self, cfg):
         ipaddr = cfg.get("last_ip")
         if ipaddr:
             self.ipaddr = ipaddr
         name = cfg.get("last_name", "Saved Device")
+        # the registry may already know a newer address for this speaker;
+        # configs saved before the device id was stored only have the name
+        device_id = self.device_id = cfg.get("last_id")
+        if device_id:
+            known = self.registry.find(device_id=device_id)
+        else:
+            known = self.registry.find(name=name)
+        if known and known["ip"] != ipaddr:
+            print(f"Saved device moved: {ipaddr} -> {known['ip']}")
+            ipaddr = self.ipaddr = known["ip"]
         self.status_label.value = "Connecting to device..."
         self.page.update()
         try:
             self.connect_to_device(ipaddr, name)
         except Exception as e:
             print(f"Auto-connect failed: {e}")
-            self.discover_devices()
+            if self.connect_known(skip=ipaddr):
+                return
+            if self.snapshot.get(device_id or ipaddr):
+                self.start_offline(ipaddr, name, device_id)
+            else:
+                self.wait_for_devices()
+
+    # Show the last known state of an unreachable device and keep probing it
+    def start_offline(self, ipaddr, name, device_id=None):
+        print("Starting offline with last known state of:", ipaddr)
+        self.ipaddr = ipaddr
+        self.device_id = device_id
+        self.device_name = name
+        self.health = DeviceHealth(ipaddr)
+        self.health.mark_unreachable()
+        self.render_snapshot()
+        self.enable_controls(True)  # commands are queued until reconnect
 
-    # Discover devices
+    # Discover devices: use what the background registry knows, else wait for
+    # the first announcement instead of blocking on a scan
     def discover_devices(self):
-        print("Trying to discover devices...")
+        if not self.connect_known():
+            self.wait_for_devices()
+
+    # Connect to the first reachable device the registry knows
+    def connect_known(self, skip=None):
+        print("Looking up known devices...")
+        for device in self.registry.devices():
+            if device["ip"] == skip:
+                continue
+            try:
+                self.ipaddr = device["ip"]
+                self.connect_to_device(device["ip"], device.get("name"))
+                self.waiting_for_device = False
+                return True
+            except Exception as e:
+                print(f"Known device {device['ip']} not reachable: {e}")
+        return False
+
+    def wait_for_devices(self):
+        print("No reachable devices yet, waiting for announcements.")
+        self.waiting_for_device = True
         self.status_label.value = "Searching for devices..."
         self.page.update()
-        try:
-            discovery = SoundTouchDiscovery(True, printToConsole=True)
-            devices = discovery.DiscoverDevices(timeout=5)
-            if devices:
-                print("Devices found.")
-                sockaddr = list(devices)
-                ipaddr = sockaddr.split(":")
-                print("IP-Address:", ipaddr)
-                self.ipaddr = ipaddr
-                self.connect_to_device(ipaddr)
-            else:
-                print("No devices found.")
-                self.status_label.value = "No devices found."
-        except Exception as e:
-            print(f"Discovery error: {e}")
-            self.status_label.value = "Device discovery error."
-            self.page.update()
+
+    # Called by the registry on a listener thread when a speaker appears or
+    # changes its address; connecting blocks, so it runs on the page loop
+    def device_changed(self, device, old_ip):
+        self.page.run_task(self.handle_device_change, device, old_ip)
+
+    async def handle_device_change(self, device, old_ip):
+        if self.waiting_for_device and not self.client:
+            # one connect at a time, whichever listener announced first
+            if not self.connect_lock.acquire(blocking=False):
+                return
+            try:
+                if not (self.waiting_for_device and not self.client):
+                    return
+                print("Device announced:", device["ip"])
+                await asyncio.to_thread(self.discover_devices)
+            finally:
+                self.connect_lock.release()
+            if self.client:
+                await self.find_media_server()
+                await asyncio.to_thread(self.refresh_filebrowser)
+        elif old_ip and old_ip == self.ipaddr and device["ip"] != old_ip:
+            # our speaker got a new DHCP address: reconnect there
+            print("Current device moved to:", device["ip"])
+            if self.scheduler:
+                self.scheduler.close()
+            self.scheduler = None
+            self.client = None
+            self.ipaddr = device["ip"]
+            self.health = DeviceHealth(device["ip"])
+            self.device_unreachable = True  # the status loop reconnects
 
     # Connect device
     def connect_to_device(self, ipaddr, name=None):
         print("Connecting to device...")
+        # fail fast with a short TCP probe before the slower HTTP check
+        health = DeviceHealth(ipaddr)
+        if not health.probe():
+            print("Connection error: device unreachable.")
+            raise ValueError("Connection failed")
+
         try:
-            requests.get(f"http://{ipaddr}:8090/info", timeout=5)
+            resp = requests.get(f"http://{ipaddr}:8090/info", timeout=5)
             print("Connected to:", ipaddr)
         except requests.RequestException:
             print("Connection error: IP request failed.")
@@ -355,13 +497,24 @@ class BoseSoundTouchController:
             self.device = SoundTouchDevice(ipaddr)
             pprint.pprint(self.device)
             self.client = SoundTouchClient(self.device)
+            if self.scheduler:
+                self.scheduler.close()
+            self.health = health
+            self.scheduler = RequestScheduler(ipaddr, health=health)
             if not name:
-                info = self.client.GetInformation()
+                info = self.request(self.client.GetInformation)
                 name = info.DeviceName
-            self.save_config(ipaddr, name)
+            self.device_name = name
+            self.device_id = info_device_id(resp.content)
+            if self.device_id:
+                # state saved before the id was known moves over to it
+                self.snapshot.adopt(ipaddr, self.device_id)
+            self.set_stale(False)
+            self.save_config(ipaddr, name, self.device_id)
             self.status_label.value = f"Connected: {name} ({ipaddr})"
             self.enable_controls(True)
             self.update_status()
+            self.load_presets(VISIBLE)
         except Exception as e:
             self.status_label.value = f"Connection failed: {e}"
             self.enable_controls(False)
@@ -385,105 +538,299 @@ class BoseSoundTouchController:
         self.open_filebrowser_btn.disabled = not enabled
         self.page.update()
 
+    # True while the device is known but not reachable
+    def offline(self):
+        return self.health is not None and not self.health.available
+
+    # Hold a command while the device is unreachable; it runs on reconnect.
+    # A newer command of the same kind replaces the older one, and a second
+    # toggle cancels the first.
+    def queue_command(self, kind, command, toggle=False):
+        with self.command_lock:
+            if toggle and kind in self.pending_commands:
+                del self.pending_commands[kind]
+            else:
+                self.pending_commands.pop(kind, None)
+                expires = time.monotonic() + COMMAND_EXPIRY
+                self.pending_commands[kind] = (command, expires)
+        print(f"Queued while offline: {kind}")
+        self.show_health()
+
+    def run_pending_commands(self):
+        with self.command_lock:
+            commands = list(self.pending_commands.items())
+            self.pending_commands.clear()
+        now = time.monotonic()
+        for kind, (command, expires) in commands:
+            if now > expires:
+                print(f"Dropped expired command: {kind}")
+                continue
+            try:
+                command()
+            except Exception as e:
+                print(f"Error running queued command {kind}: {e}")
+
+    # Grey out the labels while they show the last known state
+    def set_stale(self, stale):
+        color = ft.Colors.GREY_700 if stale else None
+        self.track_label.color = color
+        self.artist_album_label.color = (
+            ft.Colors.GREY_700 if stale else ft.Colors.GREY_500
+        )
+        self.volume_label.color = color
+
+    def render_snapshot(self):
+        state = self.snapshot.get(self.device_key()) or {}
+        now_playing = state.get("now_playing") or {}
+        self.track_label.value = now_playing.get("track", "")
+        self.artist_album_label.value = now_playing.get("artist_album", "")
+        self.track_number_label.value = now_playing.get("track_number", "")
+        if state.get("volume") is not None:
+            self.volume_label.value = f"Volume: {state['volume']}"
+            self.volume_slider.value = state["volume"]
+        if state.get("presets"):
+            self.show_preset_labels(state["presets"])
+        self.set_stale(True)
+        self.show_health()
+
+    # Run a device call through the scheduler and wait for the result
+    def request(self, fn, priority=INTERACTIVE, key=None, deadline=None):
+        if not self.scheduler:
+            return fn()
+        return self.scheduler.run(fn, priority, key, deadline)
+
+    # Read now playing status, sharing an identical read already in flight
+    def now_playing(self, priority=VISIBLE, deadline=None):
+        return self.request(
+            lambda: self.client.GetNowPlayingStatus(True),
+            priority,
+            key="now_playing",
+            deadline=deadline,
+        )
+
     # --------------------------------------------------------------------------------
     # Methods for GUI controls
     # --------------------------------------------------------------------------------
 
     # Play/pause
     def toggle_play_pause(self, e):
+        if self.offline():
+            self.queue_command(
+                "play_pause", lambda: self.toggle_play_pause(e), toggle=True
+            )
+            return
         if not self.client:
             return
         try:
-            np = self.client.GetNowPlayingStatus(True)
+            np = self.now_playing(INTERACTIVE)
             if np.PlayStatus == "PLAY_STATE":
-                self.client.MediaPause()
+                self.request(self.client.MediaPause)
             else:
-                self.client.MediaPlay()
+                self.request(self.client.MediaPlay)
             self.update_status()
         except Exception as ex:
             print(f"Error toggling play/pause: {ex}")
 
     # Previous track
     def previous_track(self, e):
-        if not self.client:
-            return
-        try:
-            np = self.client.GetNowPlayingStatus(True)
-            if np.IsSkipPreviousEnabled:
-                self.client.MediaPreviousTrack()
-            self.update_status()
-        except Exception as ex:
-            print(f"Error: {ex}")
+        self.queue_skip(-1)
 
     # Next track
     def next_track(self, e):
+        self.queue_skip(1)
+
+    # Collect rapid skip presses into a net offset, sent after SKIP_WINDOW
+    def queue_skip(self, step):
+        if not self.client and not self.offline():
+            return
+        with self.skip_lock:
+            self.pending_skip += step
+            if self.skip_timer:
+                self.skip_timer.cancel()
+            self.skip_timer = threading.Timer(SKIP_WINDOW, self.flush_skips)
+            self.skip_timer.daemon = True
+            self.skip_timer.start()
+            target = None
+            if self.track_number:
+                skips = self.offline_skip + self.pending_skip
+                target = max(self.track_number + skips, 1)
+
+        # show where we are heading before the speaker gets there
+        if target:
+            self.track_number_label.value = f"Track: {target}"
+            self.page.update()
+
+    # One status check, the net number of skips, then one status update
+    def flush_skips(self):
+        with self.skip_lock:
+            offset = self.pending_skip
+            self.pending_skip = 0
+            self.skip_timer = None
+        if offset == 0:
+            return
+        if self.offline():
+            with self.skip_lock:
+                self.offline_skip += offset
+            self.queue_command("skip", self.resend_skips)
+            return
         if not self.client:
             return
         try:
-            np = self.client.GetNowPlayingStatus(True)
-            if np.IsSkipEnabled:
-                self.client.MediaNextTrack()
+            if offset > 0 and self.play_queue.active:
+                # tracks from a folder subtree are played one by one by us
+                self.play_queue.skip(offset)
+                self.update_status()
+                return
+            np = self.now_playing(INTERACTIVE)
+            if abs(offset) > 1 and self.jump_in_folder(np, offset):
+                self.update_status()
+                return
+            if offset > 0 and np.IsSkipEnabled:
+                command = self.client.MediaNextTrack
+            elif offset < 0 and np.IsSkipPreviousEnabled:
+                command = self.client.MediaPreviousTrack
+            else:
+                command = None
+            if command:
+                for _ in range(abs(offset)):
+                    self.request(command)
             self.update_status()
         except Exception as ex:
-            print(f"Error: {ex}")
+            print(f"Error skipping tracks: {ex}")
+
+    # Play the track `offset` places away in the playing folder directly
+    #
+    # Only works for folders the file browser has listed, since listing a
+    # folder needs its library item. Playing a single track stops the
+    # speaker after it, so the rest of the folder goes to the play queue,
+    # which only moves on while the app runs. Shuffle and repeat are left to
+    # the speaker's own skip keys.
+    def jump_in_folder(self, np, offset):
+        repeat = getattr(np, "RepeatSetting", "REPEAT_OFF")
+        if np.IsShuffleEnabled or repeat != "REPEAT_OFF":
+            return False
+        location = getattr(np.ContentItem, "Location", None) if np.ContentItem else None
+        folder = self.known_folders.get(location)
+        if folder is None or not self.track_number:
+            return False
+        nav = Navigate(
+            source=SOURCE, sourceAccount=self.accountid, containerItem=folder
+        )
+        result = self.request(
+            lambda: self.client.GetMusicLibraryItems(nav),
+            key=("browse", location),
+        )
+        tracks = [item for item in result.Items if item.TypeValue == "track"]
+        target = self.track_number - 1 + offset
+        if not 0 <= target < len(tracks):
+            return False
+        generation = self.play_queue.start()
+        self.play_queue.add(
+            generation, [((pos,), tracks[pos]) for pos in range(target, len(tracks))]
+        )
+        return True
+
+    # Skips collected while offline, sent once the device is back
+    def resend_skips(self):
+        with self.skip_lock:
+            self.pending_skip += self.offline_skip
+            self.offline_skip = 0
+        self.flush_skips()
 
     # Volume
     def change_volume(self, e):
+        if self.offline():
+            self.volume_label.value = f"Volume: {int(self.volume_slider.value)}"
+            self.page.update()
+            self.queue_command("volume", lambda: self.change_volume(e))
+            return
         if not self.client:
             return
         try:
             val = int(self.volume_slider.value)
-            self.client.SetVolumeLevel(val)
+            self.request(lambda: self.client.SetVolumeLevel(val))
             self.volume_label.value = f"Volume: {val}"
             self.page.update()
         except Exception as ex:
             print(f"Error changing volume: {ex}")
 
+    # Volume step while offline: move the slider and queue the new level
+    def offline_volume_step(self, step):
+        self.volume_slider.value = min(max(self.volume_slider.value + step, 0), 100)
+        self.change_volume(None)
+
     def volume_up(self, e):
-        if self.client:
+        if self.offline():
+            self.offline_volume_step(1)
+        elif self.client:
             try:
-                self.client.VolumeUp()
+                self.request(self.client.VolumeUp)
                 self.update_status()
             except Exception as ex:
                 print(f"Error increasing volume: {ex}")
 
     def volume_down(self, e):
-        if self.client:
+        if self.offline():
+            self.offline_volume_step(-1)
+        elif self.client:
             try:
-                self.client.VolumeDown()
+                self.request(self.client.VolumeDown)
                 self.update_status()
             except Exception as ex:
                 print(f"Error decreasing volume: {ex}")
 
     # Shuffle
     def toggle_shuffle(self, e):
+        if self.offline():
+            self.queue_command("shuffle", lambda: self.toggle_shuffle(e), toggle=True)
+            return
         if not self.client:
             return
         try:
-            np = self.client.GetNowPlayingStatus(True)
+            np = self.now_playing(INTERACTIVE)
             if np.IsShuffleEnabled:
-                self.client.MediaShuffleOff()
+                self.request(self.client.MediaShuffleOff)
             else:
-                self.client.MediaShuffleOn()
+                self.request(self.client.MediaShuffleOn)
             self.update_status()
         except Exception as ex:
             print(f"Error toggling shuffle: {ex}")
 
     # NEW: Repeat mode toggle
     def toggle_repeat(self, e):
+        if self.offline():
+            with self.command_lock:
+                self.offline_repeat += 1
+            self.queue_command("repeat", self.resend_repeats)
+            return
+        self.cycle_repeat(1)
+
+    # Presses collected while offline; three of them go full circle
+    def resend_repeats(self):
+        with self.command_lock:
+            steps = self.offline_repeat % len(REPEAT_CYCLE)
+            self.offline_repeat = 0
+        if steps:
+            self.cycle_repeat(steps)
+
+    def cycle_repeat(self, steps):
         if not self.client:
             return
         try:
-            np = self.client.GetNowPlayingStatus(True)
+            np = self.now_playing(INTERACTIVE)
             current_repeat = getattr(np, "RepeatSetting", "REPEAT_OFF")
-
-            # Cycle through: OFF -> ON -> ONE -> OFF
-            if current_repeat == "REPEAT_OFF":
-                self.client.MediaRepeatAll()
-            elif current_repeat == "REPEAT_ALL":
-                self.client.MediaRepeatOne()
+            # Cycle through: OFF -> ALL -> ONE -> OFF
+            if current_repeat in REPEAT_CYCLE:
+                pos = REPEAT_CYCLE.index(current_repeat)
+            else:
+                pos = len(REPEAT_CYCLE) - 1  # unknown setting: next is OFF
+            target = REPEAT_CYCLE[(pos + steps) % len(REPEAT_CYCLE)]
+            if target == "REPEAT_ALL":
+                self.request(self.client.MediaRepeatAll)
+            elif target == "REPEAT_ONE":
+                self.request(self.client.MediaRepeatOne)
             else:
-                self.client.MediaRepeatOff()
+                self.request(self.client.MediaRepeatOff)
 
             self.update_status()
         except Exception as ex:
@@ -491,37 +838,108 @@ class BoseSoundTouchController:
 
     # Presets
     def select_preset(self, number):
+        if self.offline():
+            self.queue_command("preset", lambda: self.select_preset(number))
+            return
         if not self.client:
             return
+        self.play_queue.stop()
         try:
-            if number == 1:
-                self.client.SelectPreset1()
-            elif number == 2:
-                self.client.SelectPreset2()
-            elif number == 3:
-                self.client.SelectPreset3()
-            elif number == 4:
-                self.client.SelectPreset4()
-            elif number == 5:
-                self.client.SelectPreset5()
-            elif number == 6:
-                self.client.SelectPreset6()
-            self.status_label.value = f"Preset {number} activated"
+            # the device's preset key, so a slot changed elsewhere plays
+            # its current content; the cache only names it
+            self.request(getattr(self.client, f"SelectPreset{number}"))
+            preset = self.presets.get(self.device_key(), [None] * 6)[number - 1]
+            if preset:
+                self.status_label.value = f"Preset {number} activated: {preset.Name}"
+            else:
+                self.status_label.value = f"Preset {number} activated"
             self.page.update()
         except Exception as e:
             print(f"Error selecting preset {number}: {e}")
 
+    # Start a track from the play queue without waiting for the speaker
+    def play_queued(self, item):
+        print("Playing:", item.ContentItem.Name)
+
+        def report(future):
+            if not future.cancelled() and future.exception():
+                print(f"Play error: {future.exception()}")
+
+        future = self.scheduler.submit(
+            # no delay: the queue waits for the status report instead
+            lambda: self.client.PlayContentItem(item.ContentItem, delay=0),
+            INTERACTIVE,
+        )
+        future.add_done_callback(report)
+
+    # Fetch preset contents once per device and show them on the buttons
+    def load_presets(self, priority=VISIBLE):
+        # set up front so a failing device is not asked again every poll
+        self.presets_loaded_at = time.monotonic()
+        try:
+            slots = self.request(
+                lambda: fetch_presets(self.client), priority, key="presets"
+            )
+        except (RequestExpired, DeviceUnavailable):
+            return
+        except Exception as e:
+            print(f"Error loading presets: {e}")
+            return
+
+        old = self.presets.get(self.device_key())
+        self.presets[self.device_key()] = slots
+        if old is not None and preset_snapshot(old) == preset_snapshot(slots):
+            return  # nothing changed on the buttons
+
+        names = [preset.Name if preset else "" for preset in slots]
+        self.snapshot.update(self.device_key(), presets=names)
+        self.show_preset_labels(names)
+        self.page.update()
+
+    def show_preset_labels(self, names):
+        for btn, name in zip(self.preset_buttons, names):
+            name_text = btn.content.controls[1]
+            name_text.value = preset_label(name)
+            name_text.visible = bool(name_text.value)
+            btn.tooltip = name or None
+
     # File browser
     def show_filebrowser(self):
-        self.filebrowser_overlay.content = create_filebrowser(
-            self.client,
-            self.accountid,
-            self.last_path,
-            self.hide_filebrowser,
-            self.page,
-        )
+        # Build the browser once per client/account and keep it between open and close
+        key = (id(self.client), self.accountid)
+        if self.filebrowser is None or self.filebrowser_key != key:
+            cached = [is_standin(item) for item in self.last_path]
+            if self.client and any(cached):
+                # path was restored from the snapshot or browsed offline:
+                # keep the part that came from the device
+                del self.last_path[cached.index(True) :]
+            elif not self.client and not self.last_path:
+                self.last_path.extend(self.snapshot.load_path(self.device_key()))
+            self.filebrowser = create_filebrowser(
+                self.client,
+                self.accountid,
+                self.last_path,
+                self.hide_filebrowser,
+                self.page,
+                self.scheduler,
+                self.play_queue,
+                FolderCache(self.snapshot, self.device_key()),
+                self.known_folders,
+            )
+            self.filebrowser_key = key
+            self.filebrowser_overlay.content = self.filebrowser
         self.filebrowser_overlay.visible = True
         self.page.update()
+        self.filebrowser.data.on_show()
+
+    # Rebuild a browser showing cached folders once the device answers again;
+    # their stand-in items cannot be browsed or played on the device
+    def refresh_filebrowser(self):
+        if self.filebrowser is None or not self.filebrowser.data.showing_cached():
+            return
+        self.filebrowser_key = None
+        if self.filebrowser_overlay.visible:
+            self.show_filebrowser()
 
     def hide_filebrowser(self, e, new_path=None):
         if new_path is not None:
@@ -530,27 +948,42 @@ class BoseSoundTouchController:
         self.page.update()
 
     # Determine track number
-    def update_track_number(self):
+    def update_track_number(self, priority=VISIBLE, deadline=None):
         try:
             url = "http://" + self.ipaddr + ":8090/now_playing"
-            response = requests.get(url)
+            response = self.request(
+                lambda: requests.get(url, timeout=REQUEST_TIMEOUT),
+                priority,
+                key="now_playing_xml",
+                deadline=deadline,
+            )
             xmlroot = ET.fromstring(response.text)
             offset = xmlroot.findtext("offset")
-            if offset:
-                offset = int(offset) + 1
-                self.track_number_label.value = f"Track: {offset}"
+            self.track_number = int(offset) + 1 if offset else None
+            if self.pending_skip:
+                return  # keep the optimistic value until the skips are sent
+            if self.track_number:
+                self.track_number_label.value = f"Track: {self.track_number}"
             else:
                 self.track_number_label.value = ""
+        except (RequestExpired, DeviceUnavailable):
+            pass  # keep the last value until the next poll
         except Exception as e:
             print(f"Error determining track number: {e}")
             self.track_number_label.value = ""
 
     # Update UI elements
-    def update_status(self):
+    def update_status(self, priority=VISIBLE):
         if not self.client:
             return
+        # background polls are dropped once the next poll is due
+        deadline = None
+        if priority == BACKGROUND:
+            deadline = time.monotonic() + STATUS_INTERVAL
         try:
-            np = self.client.GetNowPlayingStatus(True)
+            np = self.now_playing(priority, deadline)
+            self.history.observe(self.ipaddr, self.device_name, np)
+            self.play_queue.on_status(np)
 
             # Playing info
             if np.ContentItem:
@@ -563,7 +996,7 @@ class BoseSoundTouchController:
                     f"{artist} • {album}" if artist and album else artist or album or ""
                 )
 
-                self.update_track_number()
+                self.update_track_number(priority, deadline)
             else:
                 self.track_label.value = ""
                 self.artist_album_label.value = ""
@@ -586,7 +1019,9 @@ class BoseSoundTouchController:
                 self.duration_label.value = "--:--"
 
             # Volume
-            vol = self.client.GetVolume()
+            vol = self.request(
+                self.client.GetVolume, priority, key="volume", deadline=deadline
+            )
             if vol:
                 self.volume_label.value = f"Volume: {vol.Actual}"
                 self.volume_slider.value = vol.Actual
@@ -610,13 +1045,28 @@ class BoseSoundTouchController:
                 ft.Icons.PAUSE if np.PlayStatus == "PLAY_STATE" else ft.Icons.PLAY_ARROW
             )
 
+            self.snapshot.update(
+                self.device_key(),
+                now_playing={
+                    "track": self.track_label.value,
+                    "artist_album": self.artist_album_label.value,
+                    "track_number": self.track_number_label.value,
+                },
+                volume=self.volume_slider.value,
+            )
+
             self.page.update()
+        except (RequestExpired, DeviceUnavailable):
+            pass
         except Exception as e:
             print(f"Update error: {e}")
 
     # keyboard
     def handle_key_event(self, e):
         # print("key pressed")
+        # Type-ahead and filter input go to the open file browser first
+        if self.filebrowser_overlay.visible and self.filebrowser.data.handle_key(e):
+            return
         if e.key == "+":
             self.volume_up(e)
         elif e.key == "-":
@@ -629,19 +1079,75 @@ class BoseSoundTouchController:
     # Background task for updating
     async def background_status_loop(self):
         while True:
-            if self.client:
+            if self.health:
                 try:
-                    self.update_status()
+                    if self.health.available and self.device_unreachable:
+                        await self.resume_device()
+                    elif self.health.available:
+                        await asyncio.to_thread(self.update_status, BACKGROUND)
+                        refresh_at = self.presets_loaded_at + PRESET_REFRESH_INTERVAL
+                        if time.monotonic() > refresh_at:
+                            await asyncio.to_thread(self.load_presets, BACKGROUND)
+                        if self.history.flush_due():
+                            await asyncio.to_thread(self.history.flush)
+                    elif self.health.probe_due():
+                        await asyncio.to_thread(self.health.probe)
+                    self.show_health()
+                    if self.snapshot.save_due():
+                        await asyncio.to_thread(self.snapshot.save)
                 except Exception as e:
                     print(f"Background update error: {e}")
-            await asyncio.sleep(1)
+            if self.registry.save_due():
+                await asyncio.to_thread(self.registry.save)
+            await asyncio.sleep(STATUS_INTERVAL)
+
+    # Show when the device is unreachable
+    def show_health(self):
+        if not self.offline():
+            return
+        seconds = int(self.health.retry_in()) + 1
+        status = f"Offline, showing last known state. Retrying in {seconds}s"
+        if self.pending_commands:
+            status += f" ({len(self.pending_commands)} queued)"
+        self.status_label.value = status
+        if not self.device_unreachable:
+            self.device_unreachable = True
+            self.set_stale(True)
+        self.page.update()
+
+    # Device is reachable again: connect if needed, then run queued commands
+    async def resume_device(self):
+        print("Device reachable again:", self.ipaddr)
+        self.device_unreachable = False
+        if not self.client:
+            try:
+                await asyncio.to_thread(
+                    self.connect_to_device, self.ipaddr, self.device_name
+                )
+                if not self.client:
+                    # connect_to_device only reports some errors on the label
+                    raise ValueError("no client after connecting")
+            except Exception as e:
+                # keep the queued commands and offline state for the next probe
+                print(f"Reconnect failed: {e}")
+                self.health.mark_unreachable()
+                self.device_unreachable = True
+                return
+            await self.find_media_server()
+        self.status_label.value = f"Connected: {self.device_name} ({self.ipaddr})"
+        self.set_stale(False)
+        await asyncio.to_thread(self.refresh_filebrowser)
+        await asyncio.to_thread(self.run_pending_commands)
+        await asyncio.to_thread(self.update_status)
 
     # Find media server
     async def find_media_server(self):
         print("Looking for media server...")
         try:
             if self.client:
-                servers = self.client.GetMediaServerList()
+                servers = await asyncio.to_thread(
+                    self.request, self.client.GetMediaServerList, VISIBLE
+                )
                 if servers:
                     server = servers[0]
                     serverid = server.ServerId + "/0"
@@ -656,6 +1162,7 @@ class BoseSoundTouchController:
 
 
 def main(page: ft.Page):
+    traffic.setup_from_env()
     controller = BoseSoundTouchController(page)
     page.run_task(controller.background_status_loop)
     page.run_task(controller.find_media_server)
@@ -0,0 +1,156 @@
+import asyncio
+import random
+import threading
+from bisect import bisect_right, insort
+
+# Folder listings fetched at the same time while enumerating a subtree
+# (matches the scheduler's default prefetch slots)
+ENUM_CONCURRENCY = 2
+
+
+# Walk all folders below `root` and pass each folder's tracks to on_tracks
+#
+# `list_items(container_item)` is an async function returning a folder's
+# items. Every track gets a sort key (its index path from the root), so
+# tracks can be kept in folder order even though listings finish in any
+# order. A folder that cannot be listed is skipped. Returns the number of
+# tracks found.
+async def enumerate_tracks(list_items, root, on_tracks, concurrency=ENUM_CONCURRENCY):
+    semaphore = asyncio.Semaphore(concurrency)
+    found = 0
+
+    async def walk(container_item, key):
+        nonlocal found
+        try:
+            async with semaphore:
+                items = await list_items(container_item)
+        except Exception as e:
+            print(f"Error listing {getattr(container_item, 'Name', 'folder')}: {e}")
+            return
+        tracks = []
+        folders = []
+        for idx, item in enumerate(items):
+            if item.TypeValue == "dir":
+                folders.append(walk(item, key + (idx,)))
+            else:
+                tracks.append((key + (idx,), item))
+        if tracks:
+            found += len(tracks)
+            on_tracks(tracks)
+        await asyncio.gather(*folders)
+
+    await walk(root, ())
+    return found
+
+
+# Client-side play queue for tracks that are not in one device container
+#
+# The speaker plays one track at a time; when it stops after a track the
+# queue plays the next one. Tracks can be added while playing, so playback
+# starts on the first track found and the rest fills in behind it. Every
+# start() and stop() begins a new generation; tracks added for an older one
+# are dropped, so an enumeration still running cannot leak into a new queue.
+class PlayQueue:
+    def __init__(self, play):
+        self.play = play  # play(item) starts a track on the speaker
+        self.keys = []  # sort keys of tracks not played yet, in order
+        self.items = {}
+        self.current = None
+        self.location = None
+        self.shuffle = False
+        self.active = False
+        self.playing = False  # one of our tracks is on the speaker
+        self.confirmed = False  # speaker reported our track as playing
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    # Start an empty queue; returns the generation to pass to add()
+    def start(self, shuffle=False):
+        with self._lock:
+            self._reset()
+            self.shuffle = shuffle
+            self.active = True
+            return self.generation
+
+    def stop(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        # called with the lock held
+        self.generation += 1
+        self.active = False
+        self.keys = []
+        self.items = {}
+        self.current = None
+        self.location = None
+        self.playing = False
+        self.confirmed = False
+
+    def add(self, generation, tracks):
+        with self._lock:
+            if not self.active or generation != self.generation:
+                return
+            for key, item in tracks:
+                insort(self.keys, key)
+                self.items[key] = item
+            if self.playing:
+                return
+            item = self._take_next()
+        if item is not None:
+            self._play(item)
+
+    # Skip `offset` tracks forward (backwards is not supported)
+    def skip(self, offset=1):
+        with self._lock:
+            if not self.active:
+                return
+            item = None
+            for _ in range(max(offset, 1)):
+                item = self._take_next() or item
+        if item is not None:
+            self._play(item)
+
+    def _take_next(self):
+        # called with the lock held
+        if not self.keys:
+            return None
+        if self.shuffle:
+            key = self.keys.pop(random.randrange(len(self.keys)))
+        else:
+            # next in folder order, then anything found earlier in the tree
+            pos = bisect_right(self.keys, self.current) if self.current else 0
+            key = self.keys.pop(pos if pos < len(self.keys) else 0)
+        self.current = key
+        self.playing = True
+        self.confirmed = False
+        item = self.items.pop(key)
+        self.location = getattr(item.ContentItem, "Location", None)
+        return item
+
+    def _play(self, item):
+        try:
+            self.play(item)
+        except Exception as e:
+            print(f"Queue play error: {e}")
+
+    # Called with every now playing status to move on after each track
+    def on_status(self, np):
+        if not self.active:
+            return
+        location = getattr(np.ContentItem, "Location", None) if np.ContentItem else None
+        with self._lock:
+            if np.PlayStatus == "PLAY_STATE":
+                if location == self.location:
+                    self.confirmed = True
+                elif self.confirmed:
+                    self._reset()  # something else was started
+                return
+            if not (np.PlayStatus == "STOP_STATE" and self.confirmed):
+                return
+            item = self._take_next()
+            if item is None:
+                self.playing = False  # wait for more tracks to be found
+                self.confirmed = False
+                return
+        self._play(item)
@@ -0,0 +1,130 @@
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from bosesoundtouchapi import SoundTouchClient, SoundTouchDevice
+from bosesoundtouchapi.models import Preset
+
+# Preset fields kept in exported files
+PRESET_FIELDS = {
+    "presetId": "PresetId",
+    "name": "Name",
+    "source": "Source",
+    "typeValue": "TypeValue",
+    "location": "Location",
+    "sourceAccount": "SourceAccount",
+    "isPresetable": "IsPresetable",
+    "containerArt": "ContainerArt",
+}
+
+# Speakers contacted at the same time by bulk operations
+MAX_PARALLEL = 8
+
+
+def preset_to_dict(preset):
+    return {key: getattr(preset, attr, None) for key, attr in PRESET_FIELDS.items()}
+
+
+def preset_from_dict(data):
+    return Preset(**{key: data.get(key) for key in PRESET_FIELDS})
+
+
+# Comparable form of a list of preset slots
+def preset_snapshot(slots):
+    return [preset_to_dict(p) if p else None for p in slots]
+
+
+# Read a device's presets as a list of 6 entries (None for empty slots)
+def fetch_presets(client, refresh=True):
+    slots = [None] * 6
+    for preset in client.GetPresetList(refresh):
+        if 1 <= preset.PresetId <= 6:
+            slots[preset.PresetId - 1] = preset
+    return slots
+
+
+# Short button label for a preset name
+def preset_label(name, length=10):
+    name = name or ""
+    return name if len(name) <= length else name[: length - 1] + "…"
+
+
+# Run fn(ipaddr) on many speakers at once; returns {ipaddr: (result, error)}
+def for_each_device(ipaddrs, fn):
+    def run(ipaddr):
+        try:
+            return fn(ipaddr), None
+        except Exception as e:
+            return None, str(e)
+
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL) as pool:
+        return dict(zip(ipaddrs, pool.map(run, ipaddrs)))
+
+
+# Save the presets of all speakers to one file
+def export_presets(ipaddrs, path):
+    def read(ipaddr):
+        client = SoundTouchClient(SoundTouchDevice(ipaddr))
+        return [preset_to_dict(p) for p in fetch_presets(client) if p is not None]
+
+    results = for_each_device(ipaddrs, read)
+    snapshot = {ip: presets for ip, (presets, error) in results.items() if not error}
+    with open(path, "w") as f:
+        json.dump(snapshot, f, indent=2)
+    return {ip: error for ip, (_, error) in results.items()}
+
+
+# Store the same preset set on many speakers at once
+def push_presets(ipaddrs, presets):
+    def store(ipaddr):
+        client = SoundTouchClient(SoundTouchDevice(ipaddr))
+        for data in presets:
+            client.StorePreset(preset_from_dict(data))
+
+    results = for_each_device(ipaddrs, store)
+    return {ip: error for ip, (_, error) in results.items()}
+
+
+def load_preset_file(path, source_ip=None):
+    with open(path, "r") as f:
+        snapshot = json.load(f)
+    if isinstance(snapshot, list):
+        return snapshot
+    if source_ip:
+        if source_ip not in snapshot:
+            raise ValueError(f"no presets for {source_ip} in {path}")
+        return snapshot[source_ip]
+    return next(iter(snapshot.values()), [])
+
+
+def print_results(results):
+    for ipaddr, error in results.items():
+        print(f"{ipaddr}: {'failed: ' + error if error else 'ok'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk SoundTouch preset tool")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export = sub.add_parser("export", help="save presets of speakers to a file")
+    export.add_argument("file")
+    export.add_argument("ipaddrs", nargs="+")
+
+    push = sub.add_parser("push", help="store presets from a file on speakers")
+    push.add_argument("file")
+    push.add_argument("ipaddrs", nargs="+")
+    push.add_argument("--source", help="speaker in the file to copy presets from")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        print_results(export_presets(args.ipaddrs, args.file))
+    else:
+        try:
+            presets = load_preset_file(args.file, args.source)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        print_results(push_presets(args.ipaddrs, presets))
+
+
+if __name__ == "__main__":
+    main()
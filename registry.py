@@ -0,0 +1,259 @@
+import json
+import re
+import socket
+import struct
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+from jsonfile import ThrottledJsonFile
+
+try:
+    from zeroconf import ServiceBrowser, ServiceStateChange, Zeroconf
+except ImportError:
+    Zeroconf = None
+
+ZEROCONF_TYPE = "_soundtouch._tcp.local."
+SSDP_GROUP = "239.255.255.250"
+SSDP_PORT = 1900
+# Minimum seconds between writes of the registry file
+SAVE_INTERVAL = 30
+# Seconds to wait for a speaker's UPnP description or capability lists
+DESCRIPTION_TIMEOUT = 3
+# Port of the SoundTouch web API when the announcement does not say
+API_PORT = 8090
+
+# Bose speakers announce UPnP descriptions under this UUID prefix
+_BOSE_USN = re.compile(r"uuid:BO5EBO5E-F00D-F00D-FEED-([0-9A-F]{12})", re.IGNORECASE)
+_UPNP_NS = {"d": "urn:schemas-upnp-org:device-1-0"}
+
+
+# Long-lived registry of SoundTouch speakers on the network
+#
+# Devices are learned passively from zeroconf announcements and SSDP NOTIFY
+# messages on background threads, keyed by their MAC address so a speaker
+# that gets a new DHCP address keeps its entry. The device set is persisted,
+# so devices() answers instantly after a restart. Each entry also records
+# the speaker's sources and supported API paths, fetched once in the
+# background. on_change(device, old_ip)
+# is called from a listener thread whenever a device appears or moves, so it
+# must hand any slow work off to another thread.
+class DeviceRegistry(ThrottledJsonFile):
+    def __init__(self, path=None, on_change=None):
+        super().__init__(
+            path or Path.home() / ".bose_soundtouch_devices.json",
+            SAVE_INTERVAL,
+            "device registry",
+        )
+        self.on_change = on_change
+        self.entries = {}  # device id -> dict
+        self._zeroconf = None
+        self._resolver = ThreadPoolExecutor(max_workers=1)
+        self._ssdp_socket = None
+        self._fetching = set()  # device ids with a capability fetch pending
+        self.load()
+
+    def load(self):
+        self.entries = self.read({})
+
+    def start(self):
+        if Zeroconf is not None:
+            try:
+                self._zeroconf = Zeroconf()
+                ServiceBrowser(
+                    self._zeroconf, ZEROCONF_TYPE, handlers=[self._on_service]
+                )
+            except Exception as e:
+                print(f"Zeroconf listener error: {e}")
+        else:
+            print("zeroconf is not installed, finding devices by SSDP only")
+        threading.Thread(target=self._listen_ssdp, name="ssdp", daemon=True).start()
+
+    def stop(self):
+        if self._zeroconf:
+            self._zeroconf.close()
+        if self._ssdp_socket:
+            self._ssdp_socket.close()
+        self._resolver.shutdown(wait=False)
+
+    # Known devices, most recently seen first
+    def devices(self):
+        with self._lock:
+            entries = [dict(e, id=i) for i, e in self.entries.items()]
+        return sorted(entries, key=lambda e: e.get("last_seen", 0), reverse=True)
+
+    def find(self, device_id=None, name=None, ipaddr=None):
+        for device in self.devices():
+            if (
+                (device_id and device["id"] == device_id)
+                or (name and device.get("name") == name)
+                or (ipaddr and device.get("ip") == ipaddr)
+            ):
+                return device
+        return None
+
+    # Record a sighting; new devices and address changes go to on_change
+    def seen(self, device_id, ipaddr, source, **details):
+        now = int(time.time())
+        with self._lock:
+            entry = self.entries.get(device_id)
+            is_new = entry is None
+            if is_new:
+                entry = self.entries[device_id] = {"first_seen": now}
+            old_ip = entry.get("ip")
+            entry.update({k: v for k, v in details.items() if v})
+            entry["ip"] = ipaddr
+            entry["source"] = source
+            entry["last_seen"] = now
+            changed = is_new or old_ip != ipaddr
+            self.dirty = True
+            fetch = "capabilities" not in entry and device_id not in self._fetching
+            if fetch:
+                self._fetching.add(device_id)
+        if fetch:
+            self._resolver.submit(self._fetch_capabilities, device_id)
+        if changed:
+            if old_ip and old_ip != ipaddr:
+                print(
+                    f"Device {entry.get('name', device_id)} moved: {old_ip} -> {ipaddr}"
+                )
+            if self.on_change:
+                try:
+                    self.on_change(dict(entry, id=device_id), old_ip)
+                except Exception as e:
+                    print(f"Device registry callback error: {e}")
+
+    # Add details learned after a sighting, without calling on_change
+    def describe(self, device_id, **details):
+        with self._lock:
+            entry = self.entries.get(device_id)
+            if entry is None:
+                return
+            entry.update({k: v for k, v in details.items() if v})
+            self.dirty = True
+
+    def dump(self):
+        return json.dumps(self.entries, indent=2)
+
+    # What the speaker supports: its source types and the API paths it serves
+    def _fetch_capabilities(self, device_id):
+        try:
+            with self._lock:
+                entry = dict(self.entries.get(device_id, {}))
+            base = f"http://{entry['ip']}:{entry.get('port') or API_PORT}"
+            with urlopen(base + "/sources", timeout=DESCRIPTION_TIMEOUT) as resp:
+                sources = ET.fromstring(resp.read())
+            with urlopen(base + "/supportedURLs", timeout=DESCRIPTION_TIMEOUT) as resp:
+                urls = ET.fromstring(resp.read())
+            self.describe(
+                device_id,
+                sources=sorted({s.get("source") for s in sources.iter("sourceItem")}),
+                capabilities=[u.get("location") for u in urls.iter("URL")],
+            )
+        except Exception as e:
+            print(f"Device capabilities error: {e}")
+        finally:
+            with self._lock:
+                self._fetching.discard(device_id)
+
+    # --------------------------------------------------------------------------------
+    # Zeroconf
+    # --------------------------------------------------------------------------------
+
+    def _on_service(self, zeroconf, service_type, name, state_change):
+        if state_change in (ServiceStateChange.Added, ServiceStateChange.Updated):
+            # resolving blocks, so it must not run on the zeroconf thread
+            self._resolver.submit(self._resolve, zeroconf, service_type, name)
+
+    def _resolve(self, zeroconf, service_type, name):
+        try:
+            info = zeroconf.get_service_info(service_type, name, timeout=3000)
+            if not info or not info.parsed_addresses():
+                return
+            props = {
+                k.decode(errors="replace"): (v or b"").decode(errors="replace")
+                for k, v in info.properties.items()
+            }
+            device_name = name[: -len(service_type) - 1]
+            mac = props.get("MAC", "").upper()
+            self.seen(
+                mac or device_name,
+                info.parsed_addresses()[0],
+                "zeroconf",
+                name=device_name,
+                mac=mac,
+                model=props.get("MODEL"),
+                description=props.get("DESCRIPTION"),
+                manufacturer=props.get("MANUFACTURER"),
+                port=info.port,
+            )
+        except Exception as e:
+            print(f"Zeroconf resolve error: {e}")
+
+    # --------------------------------------------------------------------------------
+    # SSDP
+    # --------------------------------------------------------------------------------
+
+    def _listen_ssdp(self):
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("", SSDP_PORT))
+            membership = struct.pack(
+                "4sl", socket.inet_aton(SSDP_GROUP), socket.INADDR_ANY
+            )
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError as e:
+            print(f"SSDP listener error: {e}")
+            return
+        self._ssdp_socket = sock
+        while True:
+            try:
+                data, (sender, _) = sock.recvfrom(2048)
+            except OSError:
+                return  # socket closed
+            self._on_ssdp(data.decode(errors="replace"), sender)
+
+    def _on_ssdp(self, message, sender):
+        lines = message.split("\r\n")
+        if not lines[0].startswith("NOTIFY"):
+            return
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            headers[key.strip().upper()] = value.strip()
+        if headers.get("NTS") != "ssdp:alive":
+            return
+        match = _BOSE_USN.search(headers.get("USN", ""))
+        if not match:
+            return
+        location = headers.get("LOCATION", "")
+        ipaddr = urlparse(location).hostname or sender
+        device_id = match.group(1).upper()
+        self.seen(device_id, ipaddr, "ssdp", mac=device_id)
+        with self._lock:
+            described = "model" in self.entries.get(device_id, {})
+        if location and not described:
+            # NOTIFY has no names; the description has what zeroconf reports
+            self._resolver.submit(self._describe_ssdp, device_id, location)
+
+    def _describe_ssdp(self, device_id, location):
+        try:
+            with urlopen(location, timeout=DESCRIPTION_TIMEOUT) as resp:
+                root = ET.fromstring(resp.read())
+            device = root.find("d:device", _UPNP_NS)
+            if device is None:
+                return
+            self.describe(
+                device_id,
+                name=device.findtext("d:friendlyName", None, _UPNP_NS),
+                model=device.findtext("d:modelName", None, _UPNP_NS),
+                description=device.findtext("d:modelDescription", None, _UPNP_NS),
+                manufacturer=device.findtext("d:manufacturer", None, _UPNP_NS),
+            )
+        except Exception as e:
+            print(f"SSDP description error: {e}")
@@ -0,0 +1,188 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from health import DeviceUnavailable
+
+# Priority classes (lower runs first)
+INTERACTIVE = 0  # user commands
+VISIBLE = 1  # queries for what is on screen
+BACKGROUND = 2  # status polling and prefetch
+PREFETCH = 3  # bulk listings, e.g. enumerating a folder tree to play
+
+
+class RequestExpired(Exception):
+    pass
+
+
+class _Job:
+    def __init__(self, fn, priority, key, deadline):
+        self.fn = fn
+        self.priority = priority
+        self.key = key
+        self.deadline = deadline
+        self.future = Future()
+        self.started = False
+
+
+# Per-device request scheduler
+#
+# All traffic to one speaker goes through here, so a button press does not
+# wait behind a slow poll or a large library listing. At most `max_concurrent`
+# requests run at once, and background work always leaves one slot free for
+# interactive and visible requests. PREFETCH jobs run in `max_prefetch` slots
+# of their own, so a long enumeration neither waits for nor delays the status
+# polls and button presses. Identical reads (same key) share a single
+# request while it is queued or running. Jobs still queued after their
+# deadline are dropped with RequestExpired. With a DeviceHealth attached,
+# requests fail fast with DeviceUnavailable while the device's circuit is open.
+class RequestScheduler:
+    def __init__(self, name="", max_concurrent=2, health=None, max_prefetch=2):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_prefetch = max_prefetch
+        self.health = health
+        self._queue = []
+        self._seq = itertools.count()
+        self._inflight = {}
+        self._running = 0
+        self._running_background = 0
+        self._running_prefetch = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._workers = [
+            threading.Thread(
+                target=self._worker, name=f"scheduler-{name}-{i}", daemon=True
+            )
+            for i in range(max_concurrent + max_prefetch)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    # Queue a call and return a concurrent.futures.Future for its result
+    def submit(self, fn, priority=VISIBLE, key=None, deadline=None):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Scheduler is closed")
+            if self.health and not self.health.allow_request():
+                future = Future()
+                future.set_exception(DeviceUnavailable(f"{self.name} unreachable"))
+                return future
+
+            job = self._inflight.get(key) if key is not None else None
+            if job is not None:
+                # share the pending read, raising its priority if needed
+                if not job.started and priority < job.priority:
+                    job.priority = priority
+                    heapq.heappush(self._queue, (priority, next(self._seq), job))
+                    # an idle worker may now be allowed to start it
+                    self._cond.notify()
+                if deadline is None or (
+                    job.deadline is not None and deadline > job.deadline
+                ):
+                    job.deadline = deadline
+                return job.future
+
+            job = _Job(fn, priority, key, deadline)
+            if key is not None:
+                self._inflight[key] = job
+            heapq.heappush(self._queue, (priority, next(self._seq), job))
+            self._cond.notify()
+            return job.future
+
+    # Queue a call and wait for its result
+    def run(self, fn, priority=INTERACTIVE, key=None, deadline=None):
+        return self.submit(fn, priority, key, deadline).result()
+
+    # Queue a call with a deadline `max_age` seconds from now
+    def submit_within(self, fn, max_age, priority=BACKGROUND, key=None):
+        return self.submit(fn, priority, key, time.monotonic() + max_age)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._queue:
+                _, _, job = heapq.heappop(self._queue)
+                if not job.started:
+                    job.started = True
+                    self._finish(job)
+                    job.future.cancel()
+            self._cond.notify_all()
+
+    def _next_job(self):
+        # called with the lock held; returns None if nothing may start yet
+        while self._queue:
+            priority, _, job = self._queue[0]
+            if job.started or priority != job.priority:
+                heapq.heappop(self._queue)  # stale entry after a boost
+                continue
+            if job.deadline is not None and time.monotonic() > job.deadline:
+                heapq.heappop(self._queue)
+                job.started = True
+                self._finish(job)
+                job.future.set_exception(RequestExpired("Dropped stale request"))
+                continue
+            if priority == PREFETCH:
+                if self._running_prefetch >= self.max_prefetch:
+                    return None
+            elif self._running - self._running_prefetch >= self.max_concurrent:
+                return None
+            elif priority == BACKGROUND and self._running_background >= max(
+                self.max_concurrent - 1, 1
+            ):
+                return None
+            heapq.heappop(self._queue)
+            return job
+        return None
+
+    def _finish(self, job):
+        if job.key is not None and self._inflight.get(job.key) is job:
+            del self._inflight[job.key]
+
+    def _execute(self, job):
+        if self.health and not self.health.allow_request():
+            # circuit opened while the job was queued
+            job.future.set_exception(DeviceUnavailable(f"{self.name} unreachable"))
+            return
+        try:
+            result = job.fn()
+        except BaseException as e:
+            if self.health:
+                self.health.record(e)
+            job.future.set_exception(e)
+        else:
+            if self.health:
+                self.health.record()
+            job.future.set_result(result)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    if self._closed:
+                        return
+                    self._cond.wait()
+                    job = self._next_job()
+                job.started = True
+                background = job.priority == BACKGROUND
+                prefetch = job.priority == PREFETCH
+                self._running += 1
+                if background:
+                    self._running_background += 1
+                if prefetch:
+                    self._running_prefetch += 1
+
+            if job.future.set_running_or_notify_cancel():
+                self._execute(job)
+
+            with self._cond:
+                self._finish(job)
+                self._running -= 1
+                if background:
+                    self._running_background -= 1
+                if prefetch:
+                    self._running_prefetch -= 1
+                self._cond.notify_all()
@@ -0,0 +1,135 @@
+import json
+import time
+from collections import OrderedDict
+from pathlib import Path
+from types import SimpleNamespace
+
+from jsonfile import ThrottledJsonFile
+
+# Folder listings kept per device for offline browsing
+MAX_FOLDERS = 20
+# Minimum seconds between writes of the snapshot file
+SAVE_INTERVAL = 10
+
+
+def item_to_dict(item):
+    content = getattr(item, "ContentItem", None)
+    return {
+        "n": item.Name,
+        "y": item.TypeValue,
+        "l": getattr(content, "Location", None),
+        "s": getattr(content, "Source", None),
+        "a": getattr(content, "SourceAccount", None),
+    }
+
+
+# Stand-in for a library item, good enough to show and browse offline
+def item_from_dict(data):
+    content = SimpleNamespace(
+        Name=data["n"],
+        TypeValue=data["y"],
+        Location=data["l"],
+        Source=data["s"],
+        SourceAccount=data["a"],
+    )
+    return SimpleNamespace(
+        Name=data["n"], TypeValue=data["y"], ContentItem=content, offline=True
+    )
+
+
+def is_standin(item):
+    return getattr(item, "offline", False)
+
+
+def folder_key(container_item):
+    if container_item is None:
+        return ""
+    return getattr(container_item.ContentItem, "Location", None) or ""
+
+
+# Last known state per device, persisted so the UI has something to show
+# while the speaker is unreachable
+#
+# Devices are keyed by their device id, so the state survives a new DHCP
+# address; devices whose id is not known yet are keyed by IP address until
+# adopt() moves their state over.
+#
+# update() only changes memory and marks the snapshot dirty; save() writes
+# the file and is called from the background loop at most every
+# SAVE_INTERVAL seconds.
+class StateSnapshot(ThrottledJsonFile):
+    def __init__(self, path=None):
+        super().__init__(
+            path or Path.home() / ".bose_soundtouch_state.json",
+            SAVE_INTERVAL,
+            "state snapshot",
+        )
+        self.devices = {}
+        self.load()
+
+    def load(self):
+        self.devices = self.read({})
+
+    def device(self, device_key):
+        return self.devices.setdefault(device_key, {})
+
+    def get(self, device_key):
+        return self.devices.get(device_key)
+
+    # Move state stored under a device's address to its device id
+    def adopt(self, ipaddr, device_id):
+        with self._lock:
+            if ipaddr in self.devices and device_id not in self.devices:
+                self.devices[device_id] = self.devices.pop(ipaddr)
+                self.dirty = True
+
+    # Store fields for a device; unchanged values do not dirty the snapshot
+    def update(self, device_key, **fields):
+        with self._lock:
+            state = self.device(device_key)
+            for name, value in fields.items():
+                if state.get(name) != value:
+                    state[name] = value
+                    self.dirty = True
+            if self.dirty:
+                state["updated"] = int(time.time())
+
+    def store_folder(self, device_key, container_item, items, path_stack):
+        key = folder_key(container_item)
+        with self._lock:
+            state = self.device(device_key)
+            folders = OrderedDict(state.get("folders", {}))
+            folders.pop(key, None)
+            folders[key] = [item_to_dict(i) for i in items]
+            while len(folders) > MAX_FOLDERS:
+                folders.popitem(last=False)
+            state["folders"] = folders
+            state["path"] = [item_to_dict(i) for i in path_stack]
+            self.dirty = True
+
+    def load_folder(self, device_key, container_item):
+        folders = self.devices.get(device_key, {}).get("folders", {})
+        items = folders.get(folder_key(container_item))
+        if items is None:
+            return None
+        return [item_from_dict(i) for i in items]
+
+    def load_path(self, device_key):
+        path = self.devices.get(device_key, {}).get("path", [])
+        return [item_from_dict(i) for i in path]
+
+    def dump(self):
+        return json.dumps(self.devices, separators=(",", ":"))
+
+
+# The snapshot's folder listings for one device, as used by the file browser
+class FolderCache:
+    def __init__(self, snapshot, device_key):
+        self.snapshot = snapshot
+        self.device_key = device_key
+
+    def store(self, container_item, items, path_stack):
+        self.snapshot.store_folder(self.device_key, container_item, items, path_stack)
+
+    def load(self, container_item):
+        return self.snapshot.load_folder(self.device_key, container_item)
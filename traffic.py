@@ -0,0 +1,248 @@
+import base64
+import io
+import json
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from urllib3 import HTTPResponse
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.exceptions import (
+    ConnectTimeoutError,
+    MaxRetryError,
+    NewConnectionError,
+    ProtocolError,
+    ReadTimeoutError,
+)
+
+# Record-and-replay of device traffic
+#
+# Both SoundTouchClient and the raw `requests` calls end up in urllib3's
+# HTTPConnectionPool.urlopen, so that is where requests are captured and
+# served. Set one of these environment variables before starting the app:
+#
+#   SOUNDTOUCH_RECORD=trace.jsonl   append every request/response to the trace
+#   SOUNDTOUCH_REPLAY=trace.jsonl   answer requests from the trace, no devices
+#   SOUNDTOUCH_REPLAY_SPEED=1.0     latency scale for replay (0 = no delay)
+#
+# The trace is one compact JSON object per line:
+#   t  start time in seconds since recording began
+#   ms time to the complete response in milliseconds
+#   m, u, b  method, full URL and request body
+#   s, h, d  status, headers and response body ("e": "b64" if binary)
+#
+# Requests that failed have no response; instead they record
+#   x, xm  exception type and message ("xr": type of the underlying
+#          reason when urllib3 gave up retrying; xm is then its message)
+
+_original_urlopen = HTTPConnectionPool.urlopen
+_mode = None
+
+# Headers that no longer apply once the body is stored decoded
+_DROP_HEADERS = {"content-encoding", "transfer-encoding", "content-length"}
+
+
+def _full_url(pool, url):
+    if url.startswith(("http://", "https://")):
+        return url
+    return f"{pool.scheme}://{pool.host}:{pool.port}{url}"
+
+
+def _text(body):
+    if body is None:
+        return None
+    if isinstance(body, bytes):
+        return body.decode("utf-8", errors="replace")
+    return str(body)
+
+
+def _encode_body(entry, data):
+    try:
+        entry["d"] = data.decode("utf-8")
+    except UnicodeDecodeError:
+        entry["d"] = base64.b64encode(data).decode("ascii")
+        entry["e"] = "b64"
+
+
+def _decode_body(entry):
+    if entry.get("e") == "b64":
+        return base64.b64decode(entry["d"])
+    return entry["d"].encode("utf-8")
+
+
+# Rebuild a recorded failure as the urllib3 exception requests expects
+def _make_error(entry, pool, url):
+    message = entry.get("xm", "")
+    kind = entry.get("xr") or entry["x"]
+    if kind == "ReadTimeoutError":
+        error = ReadTimeoutError(pool, url, message)
+    elif kind == "ConnectTimeoutError":
+        error = ConnectTimeoutError(message)
+    elif kind == "NewConnectionError":
+        error = NewConnectionError(pool, message)
+    else:
+        error = ProtocolError(message)
+    if entry.get("xr"):
+        error = MaxRetryError(pool, url, error)
+    return error
+
+
+def _make_response(entry, preload_content):
+    data = _decode_body(entry)
+    headers = dict(entry["h"])
+    headers["Content-Length"] = str(len(data))
+    return HTTPResponse(
+        body=io.BytesIO(data),
+        headers=headers,
+        status=entry["s"],
+        preload_content=preload_content,
+        decode_content=False,
+    )
+
+
+class TraceRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, entry):
+        line = json.dumps(entry, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def urlopen(self, pool, method, url, body=None, headers=None, **kw):
+        preload_content = kw.pop("preload_content", True)
+        kw.pop("decode_content", None)
+        start = time.monotonic()
+        entry = {
+            "t": round(start - self.started, 3),
+            "m": method,
+            "u": _full_url(pool, url),
+            "b": _text(body),
+        }
+        try:
+            resp = _original_urlopen(
+                pool,
+                method,
+                url,
+                body,
+                headers,
+                preload_content=False,
+                decode_content=True,
+                **kw,
+            )
+            data = resp.read()
+            resp.release_conn()
+        except Exception as ex:
+            entry["ms"] = round((time.monotonic() - start) * 1000, 1)
+            entry["x"] = type(ex).__name__
+            entry["xm"] = str(ex)
+            if isinstance(ex, MaxRetryError) and ex.reason is not None:
+                entry["xr"] = type(ex.reason).__name__
+                entry["xm"] = str(ex.reason)
+            self.write(entry)
+            raise
+        entry["ms"] = round((time.monotonic() - start) * 1000, 1)
+        entry["s"] = resp.status
+        entry["h"] = {
+            k: v for k, v in resp.headers.items() if k.lower() not in _DROP_HEADERS
+        }
+        _encode_body(entry, data)
+        self.write(entry)
+        return _make_response(entry, preload_content)
+
+
+class TracePlayer:
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._responses = defaultdict(list)
+        self._next = defaultdict(int)
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # partial last line from an interrupted recording
+                self._responses[(entry["m"], entry["u"], entry["b"])].append(entry)
+
+    # Next recorded response for this request; the last one repeats
+    def lookup(self, method, url, body):
+        key = (method, url, _text(body))
+        with self._lock:
+            entries = self._responses.get(key)
+            if not entries:
+                return None
+            idx = min(self._next[key], len(entries) - 1)
+            self._next[key] += 1
+            return entries[idx]
+
+    def urlopen(self, pool, method, url, body=None, headers=None, **kw):
+        full_url = _full_url(pool, url)
+        entry = self.lookup(method, full_url, body)
+        if entry is None:
+            raise ProtocolError(f"No recorded response for {method} {full_url}")
+        if self.speed:
+            time.sleep(entry["ms"] / 1000 * self.speed)
+        if "x" in entry:
+            raise _make_error(entry, pool, full_url)
+        return _make_response(entry, kw.get("preload_content", True))
+
+
+def start_recording(path):
+    global _mode
+    _mode = TraceRecorder(path)
+    HTTPConnectionPool.urlopen = lambda pool, *args, **kw: _mode.urlopen(
+        pool, *args, **kw
+    )
+    print("Recording device traffic to:", path)
+
+
+def start_replay(path, speed=1.0):
+    global _mode
+    _mode = TracePlayer(path, speed)
+    HTTPConnectionPool.urlopen = lambda pool, *args, **kw: _mode.urlopen(
+        pool, *args, **kw
+    )
+    print(f"Replaying device traffic from: {path} (speed {speed})")
+
+
+def stop():
+    global _mode
+    _mode = None
+    HTTPConnectionPool.urlopen = _original_urlopen
+
+
+def replaying():
+    return isinstance(_mode, TracePlayer)
+
+
+# TCP liveness check that always succeeds while replaying a trace
+def probe_connection(host, port, timeout):
+    if replaying():
+        return True
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+# Start recording or replay as configured in the environment
+def setup_from_env():
+    replay = os.environ.get("SOUNDTOUCH_REPLAY")
+    record = os.environ.get("SOUNDTOUCH_RECORD")
+    if replay:
+        speed = float(os.environ.get("SOUNDTOUCH_REPLAY_SPEED", "1.0"))
+        start_replay(replay, speed)
+    elif record:
+        start_recording(record)